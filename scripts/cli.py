@@ -1,16 +1,19 @@
 """Frida gadget injector for Android APK"""
 import os
 import sys
+import json
 import shutil
 import subprocess
 from shutil import which
 from pathlib import Path
 import click
-from androguard.core.apk import APK
 from .logger import logger
 from .__version__ import __version__
 from .frida_github import FridaGithub
 from .uber_apk_signer_github import UberApkSignerGithub
+from .output_cache import OutputCache
+from .strategies import (ARCH_DIRNAMES, DECODE_NONE, DECODE_RESOURCES, DECODE_FULL, STRATEGIES,
+                         InjectionContext, InjectionError, modify_manifest, select_strategies)
 from . import INSTALLED_FRIDA_VERSION
 
 
@@ -18,6 +21,7 @@ p = Path(__file__)
 ROOT_DIR = p.parent.resolve()
 TEMP_DIR = ROOT_DIR.joinpath('temp')
 FILE_DIR = ROOT_DIR.joinpath('files')
+CACHE_DIR = ROOT_DIR.joinpath('cache')
 
 APKTOOL = which("apktool")
 if not APKTOOL:
@@ -60,6 +64,50 @@ def run_apktool(option: list, apk_path: str):
                                                 sys.stdout, sys.stderr)
         return True
 
+def get_apktool_version():
+    """Return the version string printed by apktool
+
+    The version is memoized in the cache directory by the path and the
+    modification time of apktool, so a cache hit does not start the JVM.
+
+    Returns:
+        str: version of apktool, None if apktool cannot report it
+    """
+    apktool_path = os.path.realpath(APKTOOL)
+    stamp = [apktool_path, os.stat(apktool_path).st_mtime_ns]
+    apktool_jar = os.path.join(os.path.dirname(apktool_path), 'apktool.jar')
+    if os.path.exists(apktool_jar):
+        stamp.append(os.stat(apktool_jar).st_mtime_ns)
+
+    version_file = CACHE_DIR.joinpath('apktool-version.json')
+    try:
+        memo = json.loads(version_file.read_text(encoding='utf-8'))
+        if memo['stamp'] == stamp:
+            return memo['version']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    try:
+        result = subprocess.run([APKTOOL, '--version'], input=b"\n", timeout=120,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning("Failed to get the apktool version: %s", e)
+        return None
+
+    version = result.stdout.decode('utf-8', 'replace').strip()
+    if not version:
+        logger.warning("Failed to get the apktool version: empty output")
+        return None
+
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        partial_file = version_file.with_suffix(f'.{os.getpid()}.partial')
+        partial_file.write_text(json.dumps({'stamp': stamp, 'version': version}), encoding='utf-8')
+        os.replace(partial_file, version_file)
+    except OSError as e:
+        logger.debug("Failed to memoize the apktool version: %s", e)
+    return version
+
 def download_gadget(arch: str):
     """Download the frida gadget library
 
@@ -93,172 +141,130 @@ def download_signer():
     logger.debug("Downloading the %s file for signing", file)    
     return signer_github.download_signer_jar(assets, signer_path)
 
-def insert_loadlibary(decompiled_path, main_activity, load_library_name):
-    """Inject loadlibary code to main activity
+def decompile_apk(apk_path: Path, decompiled_path: Path, decode: int):
+    """Decompile the APK with apktool
 
     Args:
-        decompiled_path (str): decomplied path of apk file
-        main_activity (str): main activity of apk file
-        load_library_name (str): name of load library
+        apk_path (Path): path of apk file
+        decompiled_path (Path): decomplied path of apk file
+        decode (int): DECODE_RESOURCES to leave the dex files untouched, DECODE_FULL for smali
     """
-    logger.debug('Searching for the main activity in the smali files')
-    target_smali = None
-
-    target_relative_path = main_activity.replace(".", os.sep)
-    for directory in decompiled_path.iterdir():
-        if directory.is_dir() and directory.name.startswith("smali"):
-            target_smali = directory.joinpath(target_relative_path + ".smali")
-            if target_smali.exists():
-                break
-
-    if not target_smali or not target_smali.exists():
-        raise FileNotFoundError(f"The target class file {target_smali} was not found.")
-
-    logger.debug("Found the main activity at '%s'", str(target_smali))
-    text = target_smali.read_text()
-
-    text = text.replace(
-        "invoke-virtual {v0, v1}, Ljava/lang/Runtime;->exit(I)V", "")
-    text = text.split("\n")
-
-    logger.debug(
-        'Locating the entrypoint method and injecting the loadLibrary code')
-    status = False
-    entrypoints = [" onCreate(", "<init>"]
-    for entrypoint in entrypoints:
-        idx = 0
-        while idx != len(text):
-            line = text[idx].strip()
-            if line.startswith('.method') and entrypoint in line:
-                if ".locals" not in text[idx + 1]:
-                    idx += 1
-                    continue
-
-                if load_library_name.startswith('lib'):
-                    load_library_name = load_library_name[3:]
-                text.insert(idx + 2,
-                            "    invoke-static {v0}, "
-                            "Ljava/lang/System;->loadLibrary(Ljava/lang/String;)V")
-                text.insert(idx + 2,
-                            f"    const-string v0, "
-                            f"\"{load_library_name}\"")
-                status = True
-                break
-            idx += 1
-
-        if status:
-            break
-
-    if not status:
-        logger.error(
-            "Cannot find the appropriate position in the main activity.")
-        logger.error(
-            "Please report the issue at %s with the following information:", 
-            'https://github.com/ksg97031/frida-gadget/issues')
-        logger.error("APK Name: <Your APK Name>")
-        logger.error("APK Version: <Your APK Version>")
-        logger.error("APKTOOL Version: <Your APKTOOL Version>")
-        sys.exit(-1)
+    logger.debug('Decompiling the target APK using apktool\n"%s"', decompiled_path)
+    if decompiled_path.exists():
+        shutil.rmtree(decompiled_path)
+    decompiled_path.mkdir(parents=True)
 
-    # Replace the smali file with the new one
-    target_smali.write_text("\n".join(text))
+    # APK decompile with apktool
+    decompile_option = ['d', '-o', str(decompiled_path.resolve()), '-f']
+    if decode == DECODE_RESOURCES:
+        decompile_option += ['--no-src']
+    run_apktool(decompile_option, str(apk_path.resolve()))
 
-def modify_manifest(decompiled_path):
-    """Modify manifest permssions
+def get_decode_level(decompiled_path: Path) -> int:
+    """Return how far a directory given with --skip-decompile was decoded
 
     Args:
-        decompiled_path (str): decomplied path of apk file
+        decompiled_path (Path): decomplied path of apk file
     """
-    # Add internet permission
-    logger.debug("Checking internet permission and extractNativeLibs settings")
-    android_manifest = decompiled_path.joinpath("AndroidManifest.xml")
-    txt = android_manifest.read_text(encoding="utf-8")
-    pos = txt.index('</manifest>')
-    permission = 'android.permission.INTERNET'
-
-    if permission not in txt:
-        logger.debug(
-            "Adding 'android.permission.INTERNET' permission to AndroidManifest.xml")
-        permissions_txt = f"<uses-permission android:name='{permission}'/>"
-        txt = txt[:pos] + permissions_txt + txt[pos:]
-
-    # Set extractNativeLibs to true
-    if ':extractNativeLibs="false"' in txt:
-        logger.debug('Editing the extractNativeLibs="true"')
-        txt = txt.replace(':extractNativeLibs="false"',
-                            ':extractNativeLibs="true"')
-    android_manifest.write_text(txt, encoding="utf-8")
-
-def inject_gadget_into_apk(apk_path:str, arch:str, decompiled_path:str, main_activity:str = None, config:str = None):
+    if any(decompiled_path.glob('smali*')):
+        return DECODE_FULL
+    return DECODE_RESOURCES
+
+def copy_gadget(context: InjectionContext):
+    """Copy the frida gadget library and config to the lib directory
+
+    Args:
+        context (InjectionContext): inputs of the injection
+    """
+    lib = context.decompiled_path.joinpath('lib', context.arch_dirname)
+    if not lib.exists():
+        lib.mkdir(parents=True)
+    shutil.copy(context.gadget_path, lib.joinpath(context.gadget_library_name))
+
+    # Upload gadget config file
+    if context.config:
+        file_path = Path(context.config)
+        target_name = context.config_library_name
+        if file_path.name == target_name:
+            logger.info("Uploading Frida config file: %s", file_path.name)
+        else:
+            logger.info("Renaming and uploading Frida config file: %s -> %s", file_path.name, target_name)
+        shutil.copy(file_path, lib.joinpath(target_name))
+
+# pylint: disable=too-many-arguments
+def inject_gadget_into_apk(apk_path:str, arch:str, decompiled_path:str, main_activity:str = None, config:str = None,
+                           native_lib:str = None, low_memory:bool = False, strategy:str = 'auto',
+                           decoded:int = DECODE_NONE, allow_zip:bool = True):
     """Inject frida gadget into an APK
 
+    The applicable strategies are tried from the cheapest one, and the APK is
+    decompiled only as far as the current strategy needs.
+
     Args:
         apk (APK): path of apk file
         arch (str): architecture of the device
         decompiled_path (str): decomplied path of apk file
+        native_lib (str): native library to load the gadget from instead of the main activity
+        low_memory (bool): read the main activity from the decoded manifest instead of the APK
+        strategy (str): name of the injection strategy, 'auto' to select it
+        decoded (int): decode level of decompiled_path
+        allow_zip (bool): allow strategies that write the APK without apktool
 
     Raises:
         FileNotFoundError: file not found
         NotImplementedError: not implemented
+
+    Returns:
+        InjectionStrategy: the strategy that injected the gadget
     """
-    apk = APK(apk_path)
-    gadget_path = download_gadget(arch) # Download gadget library
-    gadget_name = Path(gadget_path).name
-    if not main_activity:
-        main_activity = apk.get_main_activity()
-
-    if not main_activity:
-        if len(apk.get_activities()) == 1:
-            logger.warn("The main activity was not found.\n"
-                        "Using the first activity from the manifest file.")
-            main_activity = apk.get_activities()[0]
-        else:
-            logger.error("The main activity was not found.\n"
-                        "Please specify the main activity using the --main-activity option.\n"
-                        "Select the activity from %s", apk.get_activities())
-            sys.exit(-1)
-    # Apply permission to android manifest
-    modify_manifest(decompiled_path)
-
-    # Search the main activity from smali files
-    load_library_name = gadget_name[:-3]
-    insert_loadlibary(decompiled_path, main_activity, load_library_name)
-
-    # Copy the frida gadget library to the lib directory
-    lib = decompiled_path.joinpath('lib')
-    if not lib.exists():
-        lib.mkdir()
-    arch_dirnames = {'arm': 'armeabi-v7a', 'x86':'x86', 'arm64': 'arm64-v8a', 'x86_64':'x86_64'}
-    if arch not in arch_dirnames:
+    if arch not in ARCH_DIRNAMES:
         raise NotImplementedError(f"The architecture '{arch}' is not supported.")
 
-    arch_dirname = arch_dirnames[arch]
-    lib = lib.joinpath(arch_dirname)
-    if not lib.exists():
-        lib.mkdir()
+    if config and not Path(config).exists():
+        logger.error("Frida config file not found: %s", config)
+        sys.exit(-1)
 
-    lib_library_name = gadget_name
-    if not lib_library_name.startswith('lib'):
-        lib_library_name = 'lib' + gadget_name
-    shutil.copy(gadget_path, lib.joinpath(lib_library_name))
+    gadget_path = download_gadget(arch) # Download gadget library
+    context = InjectionContext(apk_path, arch, decompiled_path, gadget_path, config=config,
+                               main_activity=main_activity, native_lib=native_lib,
+                               low_memory=low_memory, decoded=decoded, allow_zip=allow_zip)
+    if native_lib and not context.find_native_lib():
+        logger.warning("The native library '%s' was not found in lib/%s.\n"
+                       "Select the library from %s", native_lib, context.arch_dirname,
+                       sorted(context.probe.libraries(context.arch_dirname)))
+
+    strategies = select_strategies(context, strategy)
+    if not strategies:
+        logger.error("The '%s' injection strategy is not applicable to this APK.", strategy)
+        sys.exit(-1)
 
-
-    # Upload gadget config file
-    upload_files = {'config': config}
-
-    for file_type, file_path in upload_files.items():
-        if file_path:
-            file_path = Path(file_path)
-            if not file_path.exists():
-                logger.error("Frida %s file not found: %s", file_type, file_path)
-                sys.exit(-1)
-            else:
-                target_name = f"lib{load_library_name}.{file_type}.so"
-                if file_path.name == target_name:
-                    logger.info("Uploading Frida %s file: %s", file_type, file_path.name)
-                else:
-                    logger.info("Renaming and uploading Frida %s file: %s -> %s", file_type, file_path.name, target_name)
-                shutil.copy(file_path, lib.joinpath(target_name))
+    for candidate in strategies:
+        if candidate.decode > context.decoded:
+            decompile_apk(Path(apk_path), decompiled_path, candidate.decode)
+            context.decoded = candidate.decode
+
+        logger.debug("Injecting the gadget with the '%s' strategy", candidate.name)
+        try:
+            candidate.inject(context)
+        except InjectionError as e:
+            logger.warning("The '%s' strategy failed: %s", candidate.name, e)
+            continue
+
+        if candidate.decode != DECODE_NONE:
+            # Apply permission to android manifest
+            modify_manifest(decompiled_path)
+            copy_gadget(context)
+        return candidate
+
+    logger.error(
+        "Cannot find the appropriate position to load the gadget.")
+    logger.error(
+        "Please report the issue at %s with the following information:", 
+        'https://github.com/ksg97031/frida-gadget/issues')
+    logger.error("APK Name: <Your APK Name>")
+    logger.error("APK Version: <Your APK Version>")
+    logger.error("APKTOOL Version: <Your APKTOOL Version>")
+    sys.exit(-1)
 
 def sign_apk(apk_path:str):
     """Run uber apk signer with option
@@ -294,15 +300,25 @@ def print_version(ctx, _, value):
 @click.option('--config', help="Upload the Frida configuration file.")
 @click.option('--no-res', is_flag=True, help="Do not decode resources.")
 @click.option('--main-activity', default=None, help="Specify the main activity if desired.")
+@click.option('--native-lib', default=None,
+              help="Load the gadget as a dependency of this native library instead of the main activity.")
+@click.option('--strategy', default='auto', show_default=True,
+              type=click.Choice(['auto'] + [strategy.name for strategy in STRATEGIES]),
+              help="Injection strategy, 'auto' tries the cheapest applicable one first.")
 @click.option('--sign', is_flag=True, help="Automatically sign the APK using uber-apk-signer.")
 @click.option('--skip-decompile', is_flag=True, help="Skip decompilation if desired.")
 @click.option('--skip-recompile', is_flag=True, help="Skip recompilation if desired.")
 @click.option('--use-aapt2', is_flag=True, help="Use aapt2 instead of aapt.")
+@click.option('--low-memory', is_flag=True, help="Avoid loading the whole APK into memory.")
+@click.option('--no-cache', is_flag=True, help="Do not reuse or store previously patched APKs.")
+@click.option('--cache-size', default=2048, show_default=True,
+              help="Maximum size of the patched APK cache in MB.")
 @click.option('--version', is_flag=True, callback=print_version,
               expose_value=False, is_eager=True, help="Show version and exit.")
 @click.argument('apk_path', type=click.Path(exists=True), required=True)
-def run(apk_path: str, arch: str, config: str, no_res:bool, main_activity: str,
-        sign:bool, skip_decompile:bool, skip_recompile:bool, use_aapt2:bool):
+def run(apk_path: str, arch: str, config: str, no_res:bool, main_activity: str, native_lib: str,
+        strategy: str, sign:bool, skip_decompile:bool, skip_recompile:bool, use_aapt2:bool,
+        low_memory:bool, no_cache:bool, cache_size:int):
     """Patch an APK with the Frida gadget library"""
     apk_path = Path(apk_path)
 
@@ -320,34 +336,56 @@ def run(apk_path: str, arch: str, config: str, no_res:bool, main_activity: str,
 
     # Make temp directory for decompile
     decompiled_path = TEMP_DIR.joinpath(str(apk_path.resolve())[:-4])
-    if not skip_decompile:
-        logger.debug('Decompiling the target APK using apktool\n"%s"', decompiled_path)
-        if decompiled_path.exists():
-            shutil.rmtree(decompiled_path)
-        decompiled_path.mkdir()
-
-        # APK decompile with apktool
-        run_apktool(['d', '-o', str(decompiled_path.resolve()), '-f'], str(apk_path.resolve()))
-    else:
-        if not decompiled_path.exists():
-            logger.error("Decompiled directory not found: %s", decompiled_path)
-            sys.exit(-1)
-
-    # Process if decompile is success
-    inject_gadget_into_apk(apk_path, arch, decompiled_path, main_activity, config)
+    dist_path = decompiled_path.joinpath('dist')
+
+    if config and not Path(config).exists():
+        logger.error("Frida config file not found: %s", config)
+        sys.exit(-1)
+
+    # Reuse the output of a previous run with the same inputs
+    output_cache, cache_key = None, None
+    apktool_version = None
+    if not no_cache and not skip_decompile and not skip_recompile:
+        apktool_version = get_apktool_version()
+        if not apktool_version:
+            logger.warning("Skipping the output cache.")
+    if apktool_version:
+        output_cache = OutputCache(CACHE_DIR, cache_size * 1024 * 1024)
+        cache_key = output_cache.fingerprint(
+            str(apk_path), config,
+            frida_version=INSTALLED_FRIDA_VERSION, apktool_version=apktool_version,
+            version=__version__, arch=arch, no_res=no_res, main_activity=main_activity,
+            native_lib=native_lib, strategy=strategy, sign=sign, use_aapt2=use_aapt2,
+            low_memory=low_memory)
+        if output_cache.restore(cache_key, dist_path):
+            logger.info("Reusing the APK patched with the same inputs (--no-cache to rebuild)")
+            logger.info(dist_path.joinpath(apk_path.name))
+            return
+
+    if skip_decompile and not decompiled_path.exists():
+        logger.error("Decompiled directory not found: %s", decompiled_path)
+        sys.exit(-1)
+
+    # Decompile as far as the selected strategy needs and inject the gadget
+    decoded = get_decode_level(decompiled_path) if skip_decompile else DECODE_NONE
+    injected_by = inject_gadget_into_apk(apk_path, arch, decompiled_path, main_activity, config,
+                                         native_lib, low_memory, strategy, decoded=decoded,
+                                         allow_zip=not skip_decompile and not skip_recompile)
 
     # Rebuild with apktool, print apk_path if process is success
     if not skip_recompile:
-        logger.debug('Recompiling the new APK using apktool\n"%s"', decompiled_path)
+        if injected_by.decode != DECODE_NONE:
+            logger.debug('Recompiling the new APK using apktool\n"%s"', decompiled_path)
 
-        recompile_option = ['b']
-        if use_aapt2:
-            recompile_option += ['--use-aapt2']
-        if no_res:
-            recompile_option += ['--no-res']
+            recompile_option = ['b']
+            if use_aapt2:
+                recompile_option += ['--use-aapt2']
+            if no_res:
+                recompile_option += ['--no-res']
 
-        run_apktool(recompile_option, str(decompiled_path.resolve()))
-        apk_path = decompiled_path.joinpath('dist', apk_path.name)
+            run_apktool(recompile_option, str(decompiled_path.resolve()))
+
+        apk_path = dist_path.joinpath(apk_path.name)
         if not apk_path.exists():
             logger.error("APK not found: %s", apk_path)
         else:
@@ -357,6 +395,9 @@ def run(apk_path: str, arch: str, config: str, no_res:bool, main_activity: str,
             logger.debug('Starting APK signing using uber-apk-signer')
             sign_apk(str(apk_path))
 
+        if output_cache and apk_path.exists():
+            output_cache.store(cache_key, dist_path)
+
     logger.info(apk_path)
 
 
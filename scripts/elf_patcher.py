@@ -0,0 +1,253 @@
+"""ELF patcher for adding a DT_NEEDED dependency to an Android native library"""
+import struct
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_NOTE = 4
+PF_W = 0x2
+PF_R = 0x4
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+
+SHT_DYNAMIC = 6
+
+
+class ElfPatchError(Exception):
+    """ The native library cannot be patched """
+
+
+class _ElfLayout:
+    """ Struct formats for the 32-bit and 64-bit little-endian ELF variants """
+
+    def __init__(self, elf_class: int):
+        if elf_class == ELFCLASS64:
+            self.ehdr = '<16sHHIQQQIHHHHHH'
+            self.phdr = '<IIQQQQQQ'
+            self.shdr = '<IIQQQQIIQQ'
+            self.dyn = '<qQ'
+        elif elf_class == ELFCLASS32:
+            self.ehdr = '<16sHHIIIIIHHHHHH'
+            self.phdr = '<IIIIIIII'
+            self.shdr = '<IIIIIIIIII'
+            self.dyn = '<iI'
+        else:
+            raise ElfPatchError(f"Unknown ELF class: {elf_class}")
+        self.is_64 = elf_class == ELFCLASS64
+        self.dyn_size = struct.calcsize(self.dyn)
+
+    def unpack_phdr(self, data: bytes, offset: int) -> dict:
+        """Unpack a program header into a dict with normalized keys
+
+        Args:
+            data (bytes): program header table
+            offset (int): offset of the program header in data
+        """
+        fields = struct.unpack_from(self.phdr, data, offset)
+        if self.is_64:
+            p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align = fields
+        else:
+            p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags, p_align = fields
+        return {'type': p_type, 'flags': p_flags, 'offset': p_offset, 'vaddr': p_vaddr,
+                'paddr': p_paddr, 'filesz': p_filesz, 'memsz': p_memsz, 'align': p_align}
+
+    def pack_phdr(self, phdr: dict) -> bytes:
+        """Pack a program header returned by unpack_phdr
+
+        Args:
+            phdr (dict): program header returned by unpack_phdr
+        """
+        if self.is_64:
+            fields = (phdr['type'], phdr['flags'], phdr['offset'], phdr['vaddr'],
+                      phdr['paddr'], phdr['filesz'], phdr['memsz'], phdr['align'])
+        else:
+            fields = (phdr['type'], phdr['offset'], phdr['vaddr'], phdr['paddr'],
+                      phdr['filesz'], phdr['memsz'], phdr['flags'], phdr['align'])
+        return struct.pack(self.phdr, *fields)
+
+
+def _align_up(value: int, alignment: int) -> int:
+    if alignment <= 1:
+        return value
+    return (value + alignment - 1) // alignment * alignment
+
+
+def _vaddr_to_offset(loads: list, vaddr: int) -> int:
+    for load in loads:
+        if load['vaddr'] <= vaddr < load['vaddr'] + load['filesz']:
+            return vaddr - load['vaddr'] + load['offset']
+    raise ElfPatchError(f"Virtual address {vaddr:#x} is not mapped by any PT_LOAD segment")
+
+
+def _read_at(file, offset: int, size: int) -> bytes:
+    file.seek(offset)
+    data = file.read(size)
+    if len(data) != size:
+        raise ElfPatchError(f"Truncated ELF file: {size} bytes expected at {offset:#x}")
+    return data
+
+
+def _write_at(file, offset: int, data: bytes):
+    file.seek(offset)
+    file.write(data)
+
+
+def get_needed_libraries(so_path: str) -> list:
+    """Return the DT_NEEDED entries of a native library
+
+    Args:
+        so_path (str): path of the native library
+    """
+    with open(so_path, 'rb') as file:
+        layout, _, phdrs = _parse(file)
+        dynamic, strtab, _ = _read_dynamic(file, layout, phdrs)
+    return [_read_string(strtab, value) for tag, value in dynamic if tag == DT_NEEDED]
+
+
+def _parse(file):
+    ident = _read_at(file, 0, 16)
+    if ident[:4] != ELF_MAGIC:
+        raise ElfPatchError("Not an ELF file")
+    if ident[5] != ELFDATA2LSB:
+        raise ElfPatchError("Only little-endian ELF files are supported")
+
+    layout = _ElfLayout(ident[4])
+    ehdr = struct.unpack(layout.ehdr, _read_at(file, 0, struct.calcsize(layout.ehdr)))
+    e_phoff, e_shoff = ehdr[5], ehdr[6]
+    e_phentsize, e_phnum = ehdr[9], ehdr[10]
+    e_shentsize, e_shnum = ehdr[11], ehdr[12]
+
+    # Only the headers are read, the code and data of the library stay on disk
+    table = _read_at(file, e_phoff, e_phnum * e_phentsize)
+    phdrs = []
+    for idx in range(e_phnum):
+        phdr = layout.unpack_phdr(table, idx * e_phentsize)
+        phdr['header_offset'] = e_phoff + idx * e_phentsize
+        phdrs.append(phdr)
+
+    return layout, (e_shoff, e_shentsize, e_shnum), phdrs
+
+
+def _read_dynamic(file, layout: _ElfLayout, phdrs: list):
+    dynamic_phdr = next((phdr for phdr in phdrs if phdr['type'] == PT_DYNAMIC), None)
+    if not dynamic_phdr:
+        raise ElfPatchError("The library has no PT_DYNAMIC segment")
+
+    data = _read_at(file, dynamic_phdr['offset'], dynamic_phdr['filesz'])
+    dynamic = []
+    for offset in range(0, len(data) - layout.dyn_size + 1, layout.dyn_size):
+        tag, value = struct.unpack_from(layout.dyn, data, offset)
+        if tag == DT_NULL:
+            break
+        dynamic.append((tag, value))
+
+    values = dict(dynamic)
+    if DT_STRTAB not in values or DT_STRSZ not in values:
+        raise ElfPatchError("The library has no dynamic string table")
+
+    loads = [phdr for phdr in phdrs if phdr['type'] == PT_LOAD]
+    strtab = _read_at(file, _vaddr_to_offset(loads, values[DT_STRTAB]), values[DT_STRSZ])
+    return dynamic, strtab, dynamic_phdr
+
+
+def _read_string(strtab: bytes, offset: int) -> str:
+    end = strtab.index(b'\x00', offset)
+    return strtab[offset:end].decode('utf-8')
+
+
+def add_needed_library(so_path: str, needed_name: str) -> bool:
+    """Add a DT_NEEDED entry to a native library
+
+    The dynamic table and the dynamic string table are rebuilt at the end of
+    the file and mapped by reusing the PT_NOTE program header as a new PT_LOAD
+    segment, so existing code and data keep their addresses.
+
+    Args:
+        so_path (str): path of the native library to patch in place
+        needed_name (str): soname to add (e.g. libfrida-gadget.so)
+
+    Raises:
+        ElfPatchError: the library cannot be patched
+
+    Returns:
+        bool: False if the library already depends on needed_name
+    """
+    with open(so_path, 'r+b') as file:
+        layout, (e_shoff, e_shentsize, e_shnum), phdrs = _parse(file)
+        dynamic, strtab, dynamic_phdr = _read_dynamic(file, layout, phdrs)
+
+        needed = [_read_string(strtab, value) for tag, value in dynamic if tag == DT_NEEDED]
+        if needed_name in needed:
+            return False
+
+        note_phdr = next((phdr for phdr in phdrs if phdr['type'] == PT_NOTE), None)
+        if not note_phdr:
+            raise ElfPatchError("The library has no PT_NOTE segment to reuse")
+
+        loads = [phdr for phdr in phdrs if phdr['type'] == PT_LOAD]
+        alignment = max(load['align'] for load in loads)
+
+        # Keep the old strings at the same offsets so symbol names stay valid
+        new_strtab = strtab + needed_name.encode('utf-8') + b'\x00'
+        new_dynamic = [(DT_NEEDED, len(strtab))]
+        for tag, value in dynamic:
+            if tag == DT_STRSZ:
+                value = len(new_strtab)
+            new_dynamic.append((tag, value))
+        new_dynamic.append((DT_NULL, 0))
+
+        file_size = file.seek(0, 2)
+        segment_offset = _align_up(file_size, alignment)
+        segment_vaddr = _align_up(max(load['vaddr'] + load['memsz'] for load in loads), alignment)
+        dynamic_size = len(new_dynamic) * layout.dyn_size
+        strtab_vaddr = segment_vaddr + dynamic_size
+        new_dynamic = [(tag, strtab_vaddr if tag == DT_STRTAB else value)
+                       for tag, value in new_dynamic]
+
+        segment = b''.join(struct.pack(layout.dyn, tag, value) for tag, value in new_dynamic)
+        segment += new_strtab
+        _write_at(file, file_size, b'\x00' * (segment_offset - file_size) + segment)
+
+        # Map the new tables
+        note_phdr.update({'type': PT_LOAD, 'flags': PF_R | PF_W,
+                          'offset': segment_offset, 'vaddr': segment_vaddr,
+                          'paddr': segment_vaddr, 'filesz': len(segment),
+                          'memsz': len(segment), 'align': alignment})
+        _write_at(file, note_phdr['header_offset'], layout.pack_phdr(note_phdr))
+
+        dynamic_phdr.update({'offset': segment_offset, 'vaddr': segment_vaddr,
+                             'paddr': segment_vaddr, 'filesz': dynamic_size,
+                             'memsz': dynamic_size})
+        _write_at(file, dynamic_phdr['header_offset'], layout.pack_phdr(dynamic_phdr))
+
+        # The Android linker cross-checks .dynamic and .dynstr against PT_DYNAMIC
+        if e_shoff and e_shnum:
+            _update_sections(file, layout, e_shoff, e_shentsize, e_shnum,
+                             (segment_offset, segment_vaddr, dynamic_size),
+                             (segment_offset + dynamic_size, strtab_vaddr, len(new_strtab)))
+    return True
+
+
+def _update_sections(file, layout: _ElfLayout, e_shoff: int,
+                     e_shentsize: int, e_shnum: int, dynamic: tuple, strtab: tuple):
+    table = _read_at(file, e_shoff, e_shnum * e_shentsize)
+    for idx in range(e_shnum):
+        fields = list(struct.unpack_from(layout.shdr, table, idx * e_shentsize))
+        if fields[1] != SHT_DYNAMIC:
+            continue
+
+        fields[4], fields[3], fields[5] = dynamic  # sh_offset, sh_addr, sh_size
+        _write_at(file, e_shoff + idx * e_shentsize, struct.pack(layout.shdr, *fields))
+
+        link = fields[6]  # sh_link
+        strtab_fields = list(struct.unpack_from(layout.shdr, table, link * e_shentsize))
+        strtab_fields[4], strtab_fields[3], strtab_fields[5] = strtab
+        _write_at(file, e_shoff + link * e_shentsize, struct.pack(layout.shdr, *strtab_fields))
+        return
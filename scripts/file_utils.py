@@ -0,0 +1,86 @@
+"""Helpers for processing files without loading them into memory"""
+import hashlib
+import lzma
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(file_path: str, algorithm: str = 'sha256') -> str:
+    """Return the hex digest of a file
+
+    Args:
+        file_path (str): path of the file
+        algorithm (str): name of the hashlib algorithm
+    """
+    digest = hashlib.new(algorithm)
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _new_file_mode() -> int:
+    """Return the mode open() gives to a new file under the current umask"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def _replace(temp_path: str, file_path: Path):
+    """Move a temporary file over file_path, keeping the mode of the replaced file
+
+    NamedTemporaryFile creates files with mode 0600, which would otherwise
+    end up on the gadget library and on the patched files.
+    """
+    if file_path.exists():
+        shutil.copymode(file_path, temp_path)
+    else:
+        os.chmod(temp_path, _new_file_mode())
+    os.replace(temp_path, file_path)
+
+
+def decompress_xz(xz_path: str, output_path: str):
+    """Decompress a xz file chunk by chunk
+
+    The output is written to a temporary file first, so an interrupted run
+    never leaves a truncated file at output_path.
+
+    Args:
+        xz_path (str): path of the xz file
+        output_path (str): path of the decompressed file
+    """
+    output_path = Path(output_path)
+    with lzma.open(xz_path, 'rb') as lzma_file, \
+            tempfile.NamedTemporaryFile(dir=output_path.parent, delete=False) as output_file:
+        try:
+            shutil.copyfileobj(lzma_file, output_file, CHUNK_SIZE)
+        except BaseException:
+            output_file.close()
+            os.remove(output_file.name)
+            raise
+    _replace(output_file.name, output_path)
+
+
+def rewrite_lines(file_path: Path, transform, encoding: str = None):
+    """Rewrite a text file line by line
+
+    Args:
+        file_path (Path): path of the text file
+        transform (callable): generator function taking and yielding lines
+        encoding (str): encoding of the text file
+    """
+    file_path = Path(file_path)
+    with open(file_path, 'r', encoding=encoding) as source, \
+            tempfile.NamedTemporaryFile('w', encoding=encoding, dir=file_path.parent,
+                                        delete=False) as target:
+        try:
+            target.writelines(transform(source))
+        except BaseException:
+            target.close()
+            os.remove(target.name)
+            raise
+    _replace(target.name, file_path)
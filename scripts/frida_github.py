@@ -1,9 +1,9 @@
 """Github module for download frida gadget library"""
 # Base code is sourced from the GitHub repository of Objection.
 # Source: https://github.com/sensepost/objection/blob/master/objection/utils/patchers/github.py
-import lzma
 from pathlib import Path
 import requests
+from .file_utils import decompress_xz
 
 class FridaGithub:
     """ Interact with Github """
@@ -112,10 +112,6 @@ class FridaGithub:
 
         xz_gadget_fullpath = gadget_fullpath + ".xz"
         self.download_asset(url, xz_gadget_fullpath)
-        with lzma.open(xz_gadget_fullpath, "rb") as lzma_file:
-            decompressed_data = lzma_file.read()
-
-        with open(gadget_fullpath, "wb") as gadget_file:
-            gadget_file.write(decompressed_data)
+        decompress_xz(xz_gadget_fullpath, gadget_fullpath)
 
         return gadget_fullpath
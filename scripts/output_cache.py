@@ -0,0 +1,134 @@
+"""Cache of patched APKs keyed by the inputs of a run"""
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from .file_utils import hash_file
+
+STALE_PARTIAL_AGE = 24 * 60 * 60
+
+
+class OutputCache:
+    """ Store the dist directory of previous runs """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        """
+            Init a new instance of OutputCache
+
+            :param cache_dir: directory where the entries are stored
+            :param max_size: maximum total size of the entries in bytes
+        """
+
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+
+    @staticmethod
+    def fingerprint(apk_path: str, config: str = None, **options) -> str:
+        """
+            Build the cache key of a run.
+
+            :param apk_path: path of the input apk
+            :param config: path of the gadget config file
+            :param options: tool versions and flags that change the output
+            :return:
+        """
+
+        if not config:
+            config_key = None
+        elif os.path.exists(config):
+            config_key = hash_file(config)
+        else:
+            # Never share an entry with the runs without a config
+            config_key = {'missing': os.path.abspath(config)}
+
+        key = {
+            'apk': hash_file(apk_path),
+            'config': config_key,
+            'options': options,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def restore(self, key: str, dist_path: Path) -> bool:
+        """
+            Copy a cached entry into the dist directory.
+
+            :param key: cache key returned by fingerprint
+            :param dist_path: dist directory of the decompiled apk
+            :return: True on a cache hit
+        """
+
+        entry = self.cache_dir.joinpath(key)
+        if not entry.is_dir():
+            return False
+
+        dist_path.mkdir(parents=True, exist_ok=True)
+        try:
+            for file in entry.iterdir():
+                shutil.copy(file, dist_path.joinpath(file.name))
+        except FileNotFoundError:
+            # Evicted by a concurrent run
+            return False
+
+        # Keep the recently used entries from being evicted
+        os.utime(entry)
+        return True
+
+    def store(self, key: str, dist_path: Path):
+        """
+            Save the dist directory as a cache entry and evict the old entries.
+
+            :param key: cache key returned by fingerprint
+            :param dist_path: dist directory of the decompiled apk
+            :return:
+        """
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry = self.cache_dir.joinpath(key)
+        partial_entry = self.cache_dir.joinpath(f'{key}.{os.getpid()}.partial')
+        if partial_entry.exists():
+            shutil.rmtree(partial_entry)
+
+        partial_entry.mkdir()
+        for file in dist_path.iterdir():
+            if file.is_file():
+                shutil.copy(file, partial_entry.joinpath(file.name))
+
+        try:
+            partial_entry.rename(entry)
+        except OSError:
+            # Stored by a concurrent run with the same key
+            shutil.rmtree(partial_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """
+            Remove the least recently used entries until the cache fits in max_size.
+
+            :return:
+        """
+
+        entries = []
+        total_size = 0
+        now = time.time()
+        for entry in self.cache_dir.iterdir():
+            if not entry.is_dir():
+                continue
+            if entry.suffix == '.partial':
+                # Left over by an interrupted run
+                if now - entry.stat().st_mtime > STALE_PARTIAL_AGE:
+                    shutil.rmtree(entry, ignore_errors=True)
+                continue
+            try:
+                size = sum(file.stat().st_size for file in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except FileNotFoundError:
+                continue
+            total_size += size
+
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,649 @@
+"""Injection strategies for loading the frida gadget"""
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+import xml.etree.ElementTree as ET
+from abc import ABC, abstractmethod
+from pathlib import Path
+from androguard.core.apk import APK
+from androguard.core.axml import AXMLPrinter
+from .logger import logger
+from .elf_patcher import add_needed_library, ElfPatchError
+from .file_utils import rewrite_lines, CHUNK_SIZE
+
+ANDROID_NS = '{http://schemas.android.com/apk/res/android}'
+INTERNET_PERMISSION = 'android.permission.INTERNET'
+ARCH_DIRNAMES = {'arm': 'armeabi-v7a', 'x86':'x86', 'arm64': 'arm64-v8a', 'x86_64':'x86_64'}
+
+# How much of the APK apktool has to decode before a strategy can run
+DECODE_NONE = 0
+DECODE_RESOURCES = 1
+DECODE_FULL = 2
+DECODE_COSTS = {DECODE_NONE: 1, DECODE_RESOURCES: 10, DECODE_FULL: 100}
+
+SIGNATURE_SUFFIXES = ('.SF', '.RSA', '.DSA', '.EC', '/MANIFEST.MF')
+ZIP_ALIGNMENT_EXTRA_ID = 0xD935
+
+
+class InjectionError(Exception):
+    """ The strategy cannot inject the gadget into this APK """
+
+
+def resolve_class_name(package: str, name: str) -> str:
+    """Resolve a component name of the manifest to a fully qualified class name
+
+    Args:
+        package (str): package name of the apk
+        name (str): android:name of the component
+    """
+    if name.startswith('.'):
+        return f"{package}{name}"
+    if '.' not in name:
+        return f"{package}.{name}"
+    return name
+
+
+class ApkProbe:
+    """ Cheap lookups on the APK without decoding it """
+
+    def __init__(self, apk_path: str):
+        """
+            Read the file list and the binary manifest of the APK.
+
+            :param apk_path: path of the apk file
+        """
+
+        with zipfile.ZipFile(apk_path) as apk:
+            self.names = apk.namelist()
+            self._manifest_data = apk.read('AndroidManifest.xml')
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        """
+            Parse the binary manifest once.
+
+            :return: root element of the manifest, None if it cannot be parsed
+        """
+
+        if self._manifest is None and self._manifest_data is not None:
+            printer = AXMLPrinter(self._manifest_data)
+            self._manifest = printer.get_xml_obj() if printer.is_valid() else None
+            self._manifest_data = None
+        return self._manifest
+
+    def libraries(self, arch_dirname: str) -> list:
+        """
+            List the native libraries shipped for an ABI.
+
+            :param arch_dirname: ABI directory name (e.g. arm64-v8a)
+            :return:
+        """
+
+        prefix = f'lib/{arch_dirname}/'
+        return [name[len(prefix):] for name in self.names
+                if name.startswith(prefix) and name.endswith('.so')]
+
+    def _application(self):
+        if self.manifest is None:
+            return None
+        return self.manifest.find('application')
+
+    def has_permission(self, permission: str) -> bool:
+        """
+            Check if the manifest requests a permission.
+
+            :param permission: name of the permission
+            :return:
+        """
+
+        if self.manifest is None:
+            return False
+        return any(element.get(ANDROID_NS + 'name') == permission
+                   for element in self.manifest.iter('uses-permission'))
+
+    def extracts_native_libs(self) -> bool:
+        """
+            Check if the package manager extracts the native libraries on install.
+
+            :return:
+        """
+
+        application = self._application()
+        if application is None:
+            return False
+        return application.get(ANDROID_NS + 'extractNativeLibs') != 'false'
+
+    def application_class(self) -> str:
+        """
+            Get the custom Application subclass of the APK.
+
+            :return: class name, None if the APK uses android.app.Application
+        """
+
+        application = self._application()
+        if application is None or not application.get(ANDROID_NS + 'name'):
+            return None
+        return resolve_class_name(self.manifest.get('package'),
+                                  application.get(ANDROID_NS + 'name'))
+
+    def provider_classes(self) -> list:
+        """
+            Get the enabled content providers running in the main process.
+
+            :return: class names in manifest order
+        """
+
+        application = self._application()
+        if application is None:
+            return []
+
+        package = self.manifest.get('package')
+        providers = []
+        for provider in application.iter('provider'):
+            name = provider.get(ANDROID_NS + 'name')
+            process = provider.get(ANDROID_NS + 'process')
+            # A resource-valued enabled flag cannot be resolved without decoding
+            if not name or provider.get(ANDROID_NS + 'enabled', 'true') != 'true':
+                continue
+            if process and process != package:
+                continue
+            providers.append(resolve_class_name(package, name))
+        return providers
+
+
+class InjectionContext:
+    """ Inputs shared by the strategies while patching one APK """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, apk_path: str, arch: str, decompiled_path: Path, gadget_path: str,
+                 config: str = None, main_activity: str = None, native_lib: str = None,
+                 low_memory: bool = False, decoded: int = DECODE_NONE, allow_zip: bool = True):
+        """
+            Init a new instance of InjectionContext
+
+            :param apk_path: path of the apk file
+            :param arch: architecture of the device
+            :param decompiled_path: decompiled path of apk file
+            :param gadget_path: path of the downloaded gadget library
+            :param decoded: decode level of decompiled_path
+            :param allow_zip: whether strategies may write the APK without apktool
+        """
+
+        self.apk_path = Path(apk_path)
+        self.arch_dirname = ARCH_DIRNAMES[arch]
+        self.decompiled_path = decompiled_path
+        self.gadget_path = gadget_path
+        self.config = config
+        self.main_activity = main_activity
+        self.native_lib = native_lib
+        self.low_memory = low_memory
+        self.decoded = decoded
+        self.allow_zip = allow_zip
+        self.probe = ApkProbe(apk_path)
+
+        gadget_name = Path(gadget_path).name
+        self.load_library_name = gadget_name[:-3]
+        self.gadget_library_name = gadget_name
+        if not self.gadget_library_name.startswith('lib'):
+            self.gadget_library_name = 'lib' + gadget_name
+
+    @property
+    def config_library_name(self) -> str:
+        """
+            Name of the gadget config file next to the gadget library.
+
+            :return:
+        """
+
+        return f"lib{self.load_library_name}.config.so"
+
+    def find_native_lib(self) -> str:
+        """
+            Resolve --native-lib to a library shipped for the target ABI.
+
+            :return: file name of the library, None if not shipped
+        """
+
+        libraries = self.probe.libraries(self.arch_dirname)
+        for candidate in (self.native_lib, f"{self.native_lib}.so", f"lib{self.native_lib}.so"):
+            if candidate in libraries:
+                return candidate
+        return None
+
+
+class InjectionStrategy(ABC):
+    """ Base class of the strategies loading the gadget """
+
+    name = None
+    decode = DECODE_FULL
+    cost = 0
+
+    def estimate_cost(self, context: InjectionContext) -> int:  # pylint: disable=unused-argument
+        """
+            Estimate the cost of the strategy, dominated by how much apktool decodes.
+
+            :param context:
+            :return:
+        """
+
+        return DECODE_COSTS[self.decode] + self.cost
+
+    @abstractmethod
+    def is_applicable(self, context: InjectionContext) -> bool:
+        """
+            Cheaply check if the strategy can patch the APK, without decoding it.
+
+            :param context:
+            :return:
+        """
+
+    @abstractmethod
+    def inject(self, context: InjectionContext):
+        """
+            Make the APK load the gadget.
+
+            :param context:
+            :raises InjectionError: the strategy failed and the next one should be tried
+            :return:
+        """
+
+
+STRATEGIES = []
+
+
+def register_strategy(strategy_class):
+    """Add a strategy to the registry
+
+    Args:
+        strategy_class (type): subclass of InjectionStrategy
+    """
+    STRATEGIES.append(strategy_class())
+    return strategy_class
+
+
+def select_strategies(context: InjectionContext, name: str = 'auto') -> list:
+    """Return the applicable strategies from the cheapest to the most expensive
+
+    Args:
+        context (InjectionContext): inputs of the injection
+        name (str): strategy name, 'auto' to consider all of them
+    """
+    applicable = []
+    for strategy in STRATEGIES:
+        if name not in ('auto', strategy.name):
+            continue
+        if strategy.decode > context.decoded and context.decoded != DECODE_NONE:
+            # The directory given with --skip-decompile cannot be decoded further,
+            # e.g. it was decoded with --no-src and has no smali
+            continue
+        if strategy.decode == DECODE_NONE and not context.allow_zip:
+            continue
+        if strategy.is_applicable(context):
+            applicable.append(strategy)
+        else:
+            logger.debug("The '%s' strategy is not applicable", strategy.name)
+    return sorted(applicable, key=lambda strategy: strategy.estimate_cost(context))
+
+
+def insert_loadlibary(decompiled_path, target_class, load_library_name,
+                      entrypoints=(" onCreate(", "<init>")):
+    """Inject loadlibary code to a class
+
+    Args:
+        decompiled_path (str): decomplied path of apk file
+        target_class (str): class to inject into (e.g. the main activity)
+        load_library_name (str): name of load library
+        entrypoints (tuple): methods to inject into, in order of preference
+
+    Raises:
+        InjectionError: the class or an entrypoint was not found
+    """
+    logger.debug("Searching for '%s' in the smali files", target_class)
+    target_smali = None
+
+    target_relative_path = target_class.replace(".", os.sep)
+    for directory in decompiled_path.iterdir():
+        if directory.is_dir() and directory.name.startswith("smali"):
+            target_smali = directory.joinpath(target_relative_path + ".smali")
+            if target_smali.exists():
+                break
+
+    if not target_smali or not target_smali.exists():
+        raise InjectionError(f"The target class file {target_smali} was not found.")
+
+    logger.debug("Found the target class at '%s'", str(target_smali))
+
+    logger.debug(
+        'Locating the entrypoint method and injecting the loadLibrary code')
+    entrypoint_lines = {}
+    with open(target_smali, 'r', encoding='utf-8') as smali:
+        previous_line = None
+        for idx, line in enumerate(smali):
+            if previous_line is not None and ".locals" in line:
+                stripped = previous_line.strip()
+                for entrypoint in entrypoints:
+                    if stripped.startswith('.method') and entrypoint in stripped:
+                        entrypoint_lines.setdefault(entrypoint, idx - 1)
+            previous_line = line
+
+    target_line = next((entrypoint_lines[entrypoint] for entrypoint in entrypoints
+                        if entrypoint in entrypoint_lines), None)
+    if target_line is None:
+        raise InjectionError(f"Cannot find the appropriate position in '{target_class}'.")
+
+    if load_library_name.startswith('lib'):
+        load_library_name = load_library_name[3:]
+
+    def inject(lines):
+        for idx, line in enumerate(lines):
+            line = line.replace(
+                "invoke-virtual {v0, v1}, Ljava/lang/Runtime;->exit(I)V", "")
+            if idx == target_line + 1:
+                # v0 must be a local register, not the first parameter
+                if line.strip() == ".locals 0":
+                    line = line.replace(".locals 0", ".locals 1")
+                if not line.endswith("\n"):
+                    line += "\n"
+                yield line
+                yield f"    const-string v0, \"{load_library_name}\"\n"
+                yield ("    invoke-static {v0}, "
+                       "Ljava/lang/System;->loadLibrary(Ljava/lang/String;)V\n")
+                continue
+            yield line
+
+    # Replace the smali file with the new one
+    rewrite_lines(target_smali, inject, encoding='utf-8')
+
+
+def insert_needed_library(lib_path, native_lib, gadget_library_name):
+    """Add the gadget as a DT_NEEDED dependency of an existing native library
+
+    Args:
+        lib_path (Path): lib/<abi> directory of the decompiled apk
+        native_lib (str): name of the native library to patch (e.g. libnative.so)
+        gadget_library_name (str): file name of the gadget library
+
+    Raises:
+        InjectionError: the library was not found or cannot be patched
+    """
+    target_so = lib_path.joinpath(native_lib)
+    if not target_so.is_file():
+        libraries = sorted(so.name for so in lib_path.glob('*.so')
+                           if so.name != gadget_library_name)
+        raise InjectionError(f"The native library '{native_lib}' was not found in {lib_path}. "
+                             f"Select the library from {libraries}")
+
+    logger.debug("Adding '%s' to the DT_NEEDED entries of '%s'",
+                 gadget_library_name, target_so.name)
+    try:
+        if not add_needed_library(str(target_so), gadget_library_name):
+            logger.debug("'%s' already depends on the gadget library", target_so.name)
+    except ElfPatchError as e:
+        raise InjectionError(f"Failed to patch '{target_so.name}': {e}") from e
+
+
+def get_main_activity_from_manifest(decompiled_path):
+    """Find the launcher activity in the decoded manifest without loading the APK
+
+    The activity is selected like APK.get_main_activity() of androguard: when
+    several components are launchers, the alphabetically first activity wins.
+
+    Args:
+        decompiled_path (str): decomplied path of apk file
+
+    Returns:
+        str: name of the main activity, None if not found or not decoded
+    """
+    android_manifest = decompiled_path.joinpath("AndroidManifest.xml")
+    package = None
+    activities, launchers = set(), set()
+    actions, categories = set(), set()
+    parents = []
+    try:
+        for event, elem in ET.iterparse(str(android_manifest), events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                if elem.tag == 'manifest':
+                    package = elem.get('package')
+                elif elem.tag in ('activity', 'activity-alias'):
+                    actions, categories = set(), set()
+                elif elem.tag == 'action':
+                    actions.add(elem.get(ANDROID_NS + 'name'))
+                elif elem.tag == 'category':
+                    categories.add(elem.get(ANDROID_NS + 'name'))
+                continue
+
+            parents.pop()
+            if elem.tag in ('activity', 'activity-alias'):
+                name = elem.get(ANDROID_NS + 'name')
+                if name and elem.tag == 'activity':
+                    activities.add(resolve_class_name(package, name))
+                if name and elem.get(ANDROID_NS + 'enabled') != 'false' and \
+                        'android.intent.action.MAIN' in actions and \
+                        'android.intent.category.LAUNCHER' in categories:
+                    launchers.add(resolve_class_name(package, name))
+            # Detach the parsed element so the tree never grows
+            if parents:
+                parents[-1].remove(elem)
+    except ET.ParseError:
+        # The manifest is still binary XML with --no-res
+        return None
+
+    if not launchers:
+        return None
+    return sorted(launchers & activities or launchers)[0]
+
+
+def modify_manifest(decompiled_path):
+    """Modify manifest permssions
+
+    Args:
+        decompiled_path (str): decomplied path of apk file
+    """
+    # Add internet permission
+    logger.debug("Checking internet permission and extractNativeLibs settings")
+    android_manifest = decompiled_path.joinpath("AndroidManifest.xml")
+    permission = INTERNET_PERMISSION
+
+    def patch(lines):
+        has_permission = False
+        for line in lines:
+            pos = line.find('</manifest>')
+            if permission in (line[:pos] if pos != -1 else line):
+                has_permission = True
+            if pos != -1 and not has_permission:
+                logger.debug(
+                    "Adding 'android.permission.INTERNET' permission to AndroidManifest.xml")
+                permissions_txt = f"<uses-permission android:name='{permission}'/>"
+                line = line[:pos] + permissions_txt + line[pos:]
+                has_permission = True
+
+            # Set extractNativeLibs to true
+            if ':extractNativeLibs="false"' in line:
+                logger.debug('Editing the extractNativeLibs="true"')
+                line = line.replace(':extractNativeLibs="false"',
+                                    ':extractNativeLibs="true"')
+            yield line
+
+    rewrite_lines(android_manifest, patch, encoding="utf-8")
+
+
+def _write_zip_entry(output_apk, zinfo, source):
+    """Write a zip entry, aligning uncompressed data like zipalign does"""
+    if zinfo.compress_type == zipfile.ZIP_STORED:
+        alignment = 16384 if zinfo.filename.endswith('.so') else 4
+        header_size = 30 + len(zinfo.filename.encode('utf-8')) + 6
+        padding = -(output_apk.fp.tell() + header_size) % alignment
+        zinfo.extra = struct.pack('<HHH', ZIP_ALIGNMENT_EXTRA_ID, 2 + padding, alignment) + b'\x00' * padding
+
+    with output_apk.open(zinfo, 'w') as target:
+        shutil.copyfileobj(source, target, CHUNK_SIZE)
+
+
+def _copy_zip_info(zinfo):
+    copied = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+    copied.compress_type = zinfo.compress_type
+    copied.external_attr = zinfo.external_attr
+    copied.file_size = zinfo.file_size
+    return copied
+
+
+@register_strategy
+class NativeLibZipStrategy(InjectionStrategy):
+    """ Patch the native library inside the APK without apktool """
+
+    name = 'native-lib-zip'
+    decode = DECODE_NONE
+
+    def is_applicable(self, context):
+        # The manifest cannot be edited without apktool
+        return bool(context.native_lib) and context.find_native_lib() is not None and \
+            context.probe.has_permission(INTERNET_PERMISSION) and \
+            context.probe.extracts_native_libs()
+
+    def inject(self, context):
+        lib_dir = f'lib/{context.arch_dirname}/'
+        target_name = lib_dir + context.find_native_lib()
+        dist_path = context.decompiled_path.joinpath('dist')
+        if context.decompiled_path.exists():
+            # Leftovers of a previous run would end up in the output cache
+            shutil.rmtree(context.decompiled_path)
+        dist_path.mkdir(parents=True)
+
+        with tempfile.TemporaryDirectory(dir=dist_path) as work_dir:
+            work_dir = Path(work_dir)
+            patched_so = work_dir.joinpath(Path(target_name).name)
+            with zipfile.ZipFile(context.apk_path) as source_apk:
+                with source_apk.open(target_name) as source, open(patched_so, 'wb') as target:
+                    shutil.copyfileobj(source, target, CHUNK_SIZE)
+                try:
+                    add_needed_library(str(patched_so), context.gadget_library_name)
+                except ElfPatchError as e:
+                    raise InjectionError(f"Failed to patch '{target_name}': {e}") from e
+
+                output_path = work_dir.joinpath(context.apk_path.name)
+                with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as output_apk:
+                    for zinfo in source_apk.infolist():
+                        # The original signature is invalid after patching
+                        if zinfo.filename.startswith('META-INF/') and \
+                                zinfo.filename.upper().endswith(SIGNATURE_SUFFIXES):
+                            continue
+                        if zinfo.filename == target_name:
+                            zinfo = _copy_zip_info(zinfo)
+                            zinfo.file_size = patched_so.stat().st_size
+                            with open(patched_so, 'rb') as source:
+                                _write_zip_entry(output_apk, zinfo, source)
+                            continue
+                        with source_apk.open(zinfo) as source:
+                            _write_zip_entry(output_apk, _copy_zip_info(zinfo), source)
+
+                    upload_files = {context.gadget_library_name: context.gadget_path,
+                                    context.config_library_name: context.config}
+                    for name, file_path in upload_files.items():
+                        if file_path:
+                            zinfo = zipfile.ZipInfo(lib_dir + name)
+                            zinfo.compress_type = zipfile.ZIP_DEFLATED
+                            zinfo.external_attr = 0o644 << 16
+                            with open(file_path, 'rb') as source:
+                                _write_zip_entry(output_apk, zinfo, source)
+
+            os.replace(output_path, dist_path.joinpath(context.apk_path.name))
+
+
+@register_strategy
+class NativeLibStrategy(InjectionStrategy):
+    """ Patch the native library after decoding the resources only """
+
+    name = 'native-lib'
+    decode = DECODE_RESOURCES
+
+    def is_applicable(self, context):
+        return bool(context.native_lib) and context.find_native_lib() is not None
+
+    def inject(self, context):
+        lib = context.decompiled_path.joinpath('lib', context.arch_dirname)
+        insert_needed_library(lib, context.find_native_lib(), context.gadget_library_name)
+
+
+@register_strategy
+class ActivityStrategy(InjectionStrategy):
+    """ Load the gadget from the main activity """
+
+    name = 'activity'
+
+    def is_applicable(self, context):
+        return True
+
+    def inject(self, context):
+        main_activity = context.main_activity
+        if not main_activity and context.low_memory:
+            main_activity = get_main_activity_from_manifest(context.decompiled_path)
+            if not main_activity:
+                logger.debug("The main activity was not found in the decoded manifest, loading the APK")
+
+        if not main_activity:
+            apk = APK(str(context.apk_path))
+            main_activity = apk.get_main_activity()
+
+            if not main_activity:
+                if len(apk.get_activities()) != 1:
+                    raise InjectionError("The main activity was not found.\n"
+                                         "Please specify the main activity using the --main-activity option.\n"
+                                         f"Select the activity from {apk.get_activities()}")
+                logger.warning("The main activity was not found.\n"
+                               "Using the first activity from the manifest file.")
+                main_activity = apk.get_activities()[0]
+
+        insert_loadlibary(context.decompiled_path, main_activity, context.load_library_name)
+
+
+@register_strategy
+class ProviderStrategy(InjectionStrategy):
+    """ Load the gadget from a ContentProvider, created before Application.onCreate """
+
+    name = 'provider'
+    cost = 1
+
+    # Only the methods the framework calls, not constructor overloads
+    entrypoints = (" onCreate()Z", "constructor <init>()V")
+
+    def is_applicable(self, context):
+        return not context.main_activity and bool(context.probe.provider_classes())
+
+    def inject(self, context):
+        errors = []
+        for provider_class in context.probe.provider_classes():
+            try:
+                insert_loadlibary(context.decompiled_path, provider_class,
+                                  context.load_library_name, entrypoints=self.entrypoints)
+                return
+            except InjectionError as e:
+                logger.debug("Cannot inject into the provider '%s': %s", provider_class, e)
+                errors.append(str(e))
+        raise InjectionError(" ".join(errors))
+
+
+@register_strategy
+class ApplicationStrategy(InjectionStrategy):
+    """ Load the gadget from the constructor of the Application subclass
+
+    The Application is created in every process of the app, so each background
+    process loads the gadget too. Only tried when the other strategies fail.
+    """
+
+    name = 'application'
+    cost = 2
+
+    # Only the methods the framework calls, not constructor overloads
+    entrypoints = ("constructor <init>()V", " attachBaseContext(Landroid/content/Context;)V",
+                   " onCreate()V")
+
+    def is_applicable(self, context):
+        return not context.main_activity and context.probe.application_class() is not None
+
+    def inject(self, context):
+        insert_loadlibary(context.decompiled_path, context.probe.application_class(),
+                          context.load_library_name, entrypoints=self.entrypoints)
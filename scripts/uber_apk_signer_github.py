@@ -2,9 +2,9 @@
 # Base code is sourced from the GitHub repository of Objection.
 # Source: https://github.com/sensepost/objection/blob/master/objection/utils/patchers/github.py
 from pathlib import Path
-import hashlib
 import os
 import requests
+from .file_utils import hash_file
 
 class UberApkSignerGithub:
     """ Interact with Github """
@@ -114,9 +114,7 @@ class UberApkSignerGithub:
             checksum = checksum_file.read(64).decode('utf-8')
         
         self.download_asset(uber_apk_signer_download_url, signer_fullpath)
-        with open(signer_fullpath, 'rb') as signer_file:
-            signer_data = signer_file.read()
-            signer_hash = hashlib.sha256(signer_data).hexdigest()
+        signer_hash = hash_file(signer_fullpath)
         
         if checksum != signer_hash:
             os.remove(signer_fullpath)
@@ -1,5 +1,8 @@
 """test_cli.py"""
+import os
+import pytest
 from pathlib import Path
+from scripts import cli
 from scripts.cli import run
 from click.testing import CliRunner
 
@@ -13,3 +16,41 @@ def test_run():
     demo_apk_path = str(ROOT_DIR.joinpath('demo-apk/handtrackinggpu.apk').resolve())
     result = runner.invoke(run, [demo_apk_path])
     assert result.exit_code == 0
+
+def test_get_apktool_version(tmp_path, monkeypatch):
+    """test memoizing the apktool version by the path and mtime of apktool
+    """
+    calls_path = tmp_path.joinpath('calls')
+    apktool = tmp_path.joinpath('apktool')
+    apktool.write_text(f"#!/bin/sh\necho x >> {calls_path}\necho 2.10.0\n")
+    apktool.chmod(0o755)
+    monkeypatch.setattr(cli, 'APKTOOL', str(apktool))
+    monkeypatch.setattr(cli, 'CACHE_DIR', tmp_path.joinpath('cache'))
+
+    assert cli.get_apktool_version() == '2.10.0'
+    assert cli.get_apktool_version() == '2.10.0'
+    assert len(calls_path.read_text().split()) == 1
+
+    # A failing apktool disables the cache instead of raising
+    apktool.write_text("#!/bin/sh\nexit 1\n")
+    os.utime(apktool, (0, 0))
+    assert cli.get_apktool_version() is None
+
+def test_run_missing_config(tmp_path, monkeypatch):
+    """test failing on a missing config before the cache lookup
+    """
+    apk_path = tmp_path.joinpath('demo.apk')
+    apk_path.write_bytes(b'apk')
+    monkeypatch.setattr(cli, 'get_apktool_version', lambda: pytest.fail("cache looked up"))
+
+    result = CliRunner().invoke(run, ['--config', str(tmp_path.joinpath('typo.json')),
+                                      str(apk_path)])
+    assert result.exit_code != 0
+
+def test_get_decode_level(tmp_path):
+    """test detecting a directory decompiled with --no-src
+    """
+    tmp_path.joinpath('classes.dex').write_bytes(b'dex')
+    assert cli.get_decode_level(tmp_path) == cli.DECODE_RESOURCES
+    tmp_path.joinpath('smali_classes2').mkdir()
+    assert cli.get_decode_level(tmp_path) == cli.DECODE_FULL
@@ -0,0 +1,94 @@
+"""test_elf_patcher.py"""
+import struct
+import pytest
+from scripts.elf_patcher import add_needed_library, get_needed_libraries, ElfPatchError
+
+PT_GNU_STACK = 0x6474e551
+SHT_STRTAB, SHT_DYNAMIC = 3, 6
+
+# ELF class -> (ehdr, phdr, dyn, shdr) struct formats
+LAYOUTS = {
+    1: ('<16sHHIIIIIHHHHHH', '<IIIIIIII', '<iI', '<IIIIIIIIII'),
+    2: ('<16sHHIQQQIHHHHHH', '<IIQQQQQQ', '<qQ', '<IIQQQQIIQQ'),
+}
+
+
+def build_shared_library(path, elf_class=2, with_note=True):
+    """Build a minimal shared library with a single DT_NEEDED entry
+
+    The section headers describe .dynstr and .dynamic like a linker does.
+    """
+    ehdr_format, phdr_format, dyn_format, shdr_format = LAYOUTS[elf_class]
+    ehdr_size, phdr_size = struct.calcsize(ehdr_format), struct.calcsize(phdr_format)
+    dyn_size, shdr_size = struct.calcsize(dyn_format), struct.calcsize(shdr_format)
+
+    strtab = b'\x00libc.so\x00'
+    dynamic_offset = ehdr_size + phdr_size * 3
+    strtab_offset = dynamic_offset + dyn_size * 4
+    dynamic = b''.join(struct.pack(dyn_format, tag, value) for tag, value in
+                       ((1, 1), (5, strtab_offset), (10, len(strtab)), (0, 0)))
+    shdr_offset = strtab_offset + len(strtab)
+    file_size = shdr_offset
+
+    def phdr(p_type, p_flags, offset, filesz, align):
+        if elf_class == 2:
+            return struct.pack(phdr_format, p_type, p_flags, offset, offset, offset,
+                               filesz, filesz, align)
+        return struct.pack(phdr_format, p_type, offset, offset, offset,
+                           filesz, filesz, p_flags, align)
+
+    data = struct.pack(ehdr_format, b'\x7fELF' + bytes([elf_class, 1, 1]) + b'\x00' * 9,
+                       3, 183 if elf_class == 2 else 40, 1, 0, ehdr_size, shdr_offset, 0,
+                       ehdr_size, phdr_size, 3, shdr_size, 3, 0)
+    data += phdr(1, 6, 0, file_size, 0x1000)
+    data += phdr(2, 6, dynamic_offset, len(dynamic), 8)
+    data += phdr(4 if with_note else PT_GNU_STACK, 4, 0, 0, 4)
+    data += dynamic + strtab
+    data += struct.pack(shdr_format, *([0] * 10))
+    data += struct.pack(shdr_format, 0, SHT_STRTAB, 2, strtab_offset, strtab_offset,
+                        len(strtab), 0, 0, 1, 0)
+    data += struct.pack(shdr_format, 0, SHT_DYNAMIC, 3, dynamic_offset, dynamic_offset,
+                        len(dynamic), 1, 0, 8, dyn_size)
+    path.write_bytes(data)
+
+
+def read_section(path, elf_class, index):
+    """Return (sh_addr, sh_offset, sh_size) of a section header
+    """
+    ehdr_format, _, _, shdr_format = LAYOUTS[elf_class]
+    data = path.read_bytes()
+    ehdr = struct.unpack_from(ehdr_format, data, 0)
+    fields = struct.unpack_from(shdr_format, data, ehdr[6] + index * ehdr[11])
+    return fields[3], fields[4], fields[5]
+
+
+@pytest.mark.parametrize('elf_class', [1, 2])
+def test_add_needed_library(tmp_path, elf_class):
+    """test adding the gadget to the DT_NEEDED entries
+    """
+    so_path = tmp_path.joinpath('libnative.so')
+    build_shared_library(so_path, elf_class)
+
+    assert add_needed_library(str(so_path), 'libfrida-gadget.so')
+    assert get_needed_libraries(str(so_path)) == ['libfrida-gadget.so', 'libc.so']
+    assert not add_needed_library(str(so_path), 'libfrida-gadget.so')
+
+    # The Android linker checks the sections against the new PT_DYNAMIC
+    dynstr_addr, dynstr_offset, dynstr_size = read_section(so_path, elf_class, 1)
+    dynamic_addr, dynamic_offset, _ = read_section(so_path, elf_class, 2)
+    assert dynamic_offset % 0x1000 == 0 and dynamic_addr % 0x1000 == 0
+    assert dynstr_offset > dynamic_offset
+    assert dynstr_addr - dynamic_addr == dynstr_offset - dynamic_offset
+    assert dynstr_size == len(b'\x00libc.so\x00libfrida-gadget.so\x00')
+
+
+def test_add_needed_library_without_note(tmp_path):
+    """test refusing a library without a PT_NOTE segment to reuse
+    """
+    so_path = tmp_path.joinpath('libnative.so')
+    build_shared_library(so_path, with_note=False)
+    original = so_path.read_bytes()
+
+    with pytest.raises(ElfPatchError):
+        add_needed_library(str(so_path), 'libfrida-gadget.so')
+    assert so_path.read_bytes() == original
@@ -0,0 +1,33 @@
+"""test_file_utils.py"""
+import lzma
+import os
+from scripts.file_utils import decompress_xz, rewrite_lines
+
+
+def test_decompress_xz_mode(tmp_path):
+    """test the decompressed gadget gets the mode of a newly created file
+    """
+    xz_path = tmp_path.joinpath('frida-gadget.so.xz')
+    with lzma.open(xz_path, 'wb') as xz_file:
+        xz_file.write(b'gadget')
+
+    umask = os.umask(0o022)
+    try:
+        so_path = tmp_path.joinpath('frida-gadget.so')
+        decompress_xz(str(xz_path), str(so_path))
+    finally:
+        os.umask(umask)
+    assert so_path.read_bytes() == b'gadget'
+    assert so_path.stat().st_mode & 0o777 == 0o644
+
+
+def test_rewrite_lines_mode(tmp_path):
+    """test rewriting a file keeps its mode
+    """
+    smali_path = tmp_path.joinpath('MainActivity.smali')
+    smali_path.write_text('a\nb\n', encoding='utf-8')
+    smali_path.chmod(0o664)
+
+    rewrite_lines(smali_path, lambda lines: (line.upper() for line in lines), encoding='utf-8')
+    assert smali_path.read_text(encoding='utf-8') == 'A\nB\n'
+    assert smali_path.stat().st_mode & 0o777 == 0o664
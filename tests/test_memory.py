@@ -0,0 +1,120 @@
+"""test_memory.py"""
+import lzma
+import tracemalloc
+from scripts.elf_patcher import add_needed_library, get_needed_libraries
+from scripts.file_utils import decompress_xz, hash_file
+from scripts.strategies import get_main_activity_from_manifest, insert_loadlibary, modify_manifest
+from tests.test_elf_patcher import build_shared_library
+
+FILE_SIZE = 32 * 1024 * 1024
+PEAK_LIMIT = 4 * 1024 * 1024
+# The lzma reader keeps a fixed ~12MB of buffers whatever the file size
+XZ_PEAK_LIMIT = FILE_SIZE // 2
+
+
+def peak_memory(func, *args):
+    """Return the peak memory allocated while running func
+    """
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def write_large_file(path, header, line, footer):
+    """Write a text file of about FILE_SIZE bytes
+    """
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(header)
+        for _ in range(FILE_SIZE // len(line)):
+            file.write(line)
+        file.write(footer)
+
+
+def test_hash_file_memory(tmp_path):
+    """test hashing the signer jar in chunks
+    """
+    jar_path = tmp_path.joinpath('uber-apk-signer.jar')
+    with open(jar_path, 'wb') as jar:
+        jar.truncate(FILE_SIZE)
+
+    assert peak_memory(hash_file, str(jar_path)) < PEAK_LIMIT
+
+
+def test_decompress_xz_memory(tmp_path):
+    """test decompressing the gadget in chunks
+    """
+    xz_path = tmp_path.joinpath('frida-gadget.so.xz')
+    with lzma.open(xz_path, 'wb') as xz_file:
+        for _ in range(FILE_SIZE // (1024 * 1024)):
+            xz_file.write(b'\x00' * 1024 * 1024)
+
+    so_path = tmp_path.joinpath('frida-gadget.so')
+    assert peak_memory(decompress_xz, str(xz_path), str(so_path)) < XZ_PEAK_LIMIT
+    assert so_path.stat().st_size == FILE_SIZE
+
+
+def test_add_needed_library_memory(tmp_path):
+    """test patching the native library by its headers only
+    """
+    so_path = tmp_path.joinpath('libnative.so')
+    build_shared_library(so_path)
+    with open(so_path, 'ab') as so_file:
+        so_file.truncate(FILE_SIZE)
+
+    assert peak_memory(add_needed_library, str(so_path), 'libfrida-gadget.so') < PEAK_LIMIT
+    assert get_needed_libraries(str(so_path)) == ['libfrida-gadget.so', 'libc.so']
+
+
+def test_insert_loadlibary_memory(tmp_path):
+    """test patching the main activity line by line
+    """
+    smali_dir = tmp_path.joinpath('smali', 'com', 'example')
+    smali_dir.mkdir(parents=True)
+    smali_path = smali_dir.joinpath('MainActivity.smali')
+    write_large_file(smali_path,
+                     '.class public Lcom/example/MainActivity;\n'
+                     '.method protected onCreate(Landroid/os/Bundle;)V\n'
+                     '    .locals 1\n',
+                     '    nop\n',
+                     '.end method\n')
+
+    peak = peak_memory(insert_loadlibary, tmp_path, 'com.example.MainActivity', 'libfrida-gadget')
+    assert peak < PEAK_LIMIT
+    with open(smali_path, encoding='utf-8') as smali:
+        lines = [next(smali) for _ in range(5)]
+    assert lines[3] == '    const-string v0, "frida-gadget"\n'
+
+
+def test_modify_manifest_memory(tmp_path):
+    """test patching the manifest line by line
+    """
+    manifest_path = tmp_path.joinpath('AndroidManifest.xml')
+    write_large_file(manifest_path,
+                     '<manifest package="com.example">\n'
+                     '<application android:extractNativeLibs="false">\n',
+                     '<meta-data android:name="key" android:value="value"/>\n',
+                     '</application>\n</manifest>\n')
+
+    assert peak_memory(modify_manifest, tmp_path) < PEAK_LIMIT
+    with open(manifest_path, encoding='utf-8') as manifest:
+        assert 'android:extractNativeLibs="true"' in manifest.readline() + manifest.readline()
+        assert "android.permission.INTERNET" in list(manifest)[-1]
+
+
+def test_get_main_activity_from_manifest_memory(tmp_path):
+    """test finding the launcher activity without building the whole manifest tree
+    """
+    write_large_file(tmp_path.joinpath('AndroidManifest.xml'),
+                     '<manifest xmlns:android="http://schemas.android.com/apk/res/android" '
+                     'package="com.example">\n<application>\n',
+                     '<activity android:name=".Other"><meta-data android:name="key"/></activity>\n',
+                     '<activity android:name=".Main"><intent-filter>'
+                     '<action android:name="android.intent.action.MAIN"/>'
+                     '<category android:name="android.intent.category.LAUNCHER"/>'
+                     '</intent-filter></activity>\n</application>\n</manifest>\n')
+
+    assert peak_memory(get_main_activity_from_manifest, tmp_path) < PEAK_LIMIT
+    assert get_main_activity_from_manifest(tmp_path) == 'com.example.Main'
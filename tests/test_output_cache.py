@@ -0,0 +1,44 @@
+"""test_output_cache.py"""
+import os
+from scripts.output_cache import OutputCache
+
+
+def test_restore_and_evict(tmp_path):
+    """test cache hits and size-based eviction
+    """
+    apk_path = tmp_path.joinpath('demo.apk')
+    apk_path.write_bytes(b'apk')
+    cache = OutputCache(tmp_path.joinpath('cache'), max_size=1024)
+
+    keys = []
+    for idx in range(3):
+        dist_path = tmp_path.joinpath(f'dist{idx}')
+        dist_path.mkdir()
+        dist_path.joinpath('demo.apk').write_bytes(b'\x00' * 500)
+        keys.append(cache.fingerprint(str(apk_path), arch='arm64', run=idx))
+        cache.store(keys[-1], dist_path)
+        entry = cache.cache_dir.joinpath(keys[-1])
+        os.utime(entry, (idx, idx))
+
+    cache.evict()
+    restored_path = tmp_path.joinpath('restored')
+    assert not cache.restore(keys[0], restored_path)
+    assert cache.restore(keys[2], restored_path)
+    assert restored_path.joinpath('demo.apk').stat().st_size == 500
+    assert keys[0] != cache.fingerprint(str(apk_path), arch='arm', run=0)
+
+
+def test_fingerprint_config(tmp_path):
+    """test keeping the runs with a missing config apart from the runs without one
+    """
+    apk_path = tmp_path.joinpath('demo.apk')
+    apk_path.write_bytes(b'apk')
+    config_path = tmp_path.joinpath('config.json')
+    config_path.write_text('{}')
+
+    keys = {
+        OutputCache.fingerprint(str(apk_path), None),
+        OutputCache.fingerprint(str(apk_path), str(config_path)),
+        OutputCache.fingerprint(str(apk_path), str(tmp_path.joinpath('typo.json'))),
+    }
+    assert len(keys) == 3
@@ -0,0 +1,331 @@
+"""test_strategies.py"""
+import struct
+import zipfile
+import pytest
+from androguard.core.apk import APK
+from scripts import cli, strategies
+from scripts.elf_patcher import get_needed_libraries
+from scripts.strategies import (DECODE_RESOURCES, DECODE_FULL, InjectionContext, InjectionError,
+                                InjectionStrategy, ApkProbe, ApplicationStrategy, ProviderStrategy,
+                                NativeLibZipStrategy, get_main_activity_from_manifest,
+                                insert_loadlibary, select_strategies)
+from tests.test_elf_patcher import build_shared_library
+
+ANDROID_URI = 'http://schemas.android.com/apk/res/android'
+GADGET_NAME = 'frida-gadget-16.0.0-android-arm64.so'
+
+
+def build_binary_manifest(root):
+    """Encode (tag, attributes, children) as binary XML like aapt does
+
+    Attribute values may be a str, a bool or an int resource reference.
+    """
+    strings = []
+
+    def string_index(value):
+        if value not in strings:
+            strings.append(value)
+        return strings.index(value)
+
+    def chunk(chunk_type, header, body=b''):
+        return struct.pack('<HHI', chunk_type, 8 + len(header),
+                           8 + len(header) + len(body)) + header + body
+
+    def element(tag, attributes, children):
+        encoded = b''
+        for name, value in attributes.items():
+            namespace = string_index(ANDROID_URI) if name.startswith('android:') else 0xFFFFFFFF
+            name_index = string_index(name.split(':')[-1])
+            if isinstance(value, bool):
+                raw, data_type, data = 0xFFFFFFFF, 0x12, 0xFFFFFFFF if value else 0
+            elif isinstance(value, int):
+                raw, data_type, data = 0xFFFFFFFF, 0x01, value
+            else:
+                raw = data = string_index(value)
+                data_type = 0x03
+            encoded += struct.pack('<IIIHBBI', namespace, name_index, raw, 8, 0, data_type, data)
+        start = chunk(0x0102, struct.pack('<II', 1, 0xFFFFFFFF),
+                      struct.pack('<IIHHHHHH', 0xFFFFFFFF, string_index(tag), 20, 20,
+                                  len(attributes), 0, 0, 0) + encoded)
+        end = chunk(0x0103, struct.pack('<II', 1, 0xFFFFFFFF),
+                    struct.pack('<II', 0xFFFFFFFF, string_index(tag)))
+        return start + b''.join(element(*child) for child in children) + end
+
+    namespace = struct.pack('<II', string_index('android'), string_index(ANDROID_URI))
+    body = chunk(0x0100, struct.pack('<II', 1, 0xFFFFFFFF), namespace)
+    body += element(*root)
+    body += chunk(0x0101, struct.pack('<II', 1, 0xFFFFFFFF), namespace)
+
+    encoded_strings, offsets = b'', []
+    for value in strings:
+        offsets.append(len(encoded_strings))
+        encoded_strings += struct.pack('<H', len(value)) + value.encode('utf-16-le') + b'\x00\x00'
+    encoded_strings += b'\x00' * (-len(encoded_strings) % 4)
+    pool = chunk(0x0001, struct.pack('<IIIII', len(strings), 0, 0, 28 + 4 * len(strings), 0),
+                 struct.pack(f'<{len(strings)}I', *offsets) + encoded_strings)
+    return chunk(0x0003, b'', pool + body)
+
+
+def build_apk(tmp_path, application=None, components=(), permissions=(), libraries=()):
+    """Build a small APK with a binary manifest and native libraries
+    """
+    children = [('uses-permission', {'android:name': permission}, []) for permission in permissions]
+    children.append(('application', application or {}, list(components)))
+    manifest = build_binary_manifest(('manifest', {'package': 'com.example'}, children))
+
+    apk_path = tmp_path.joinpath('demo.apk')
+    with zipfile.ZipFile(apk_path, 'w') as apk:
+        apk.writestr('AndroidManifest.xml', manifest)
+        apk.writestr('resources.arsc', b'arsc', zipfile.ZIP_STORED)
+        apk.writestr('META-INF/CERT.RSA', b'signature')
+        for name, so_path in libraries:
+            apk.write(so_path, f'lib/arm64-v8a/{name}', zipfile.ZIP_DEFLATED)
+    return apk_path
+
+
+def build_context(tmp_path, apk_path, **kwargs):
+    """Build the injection context of an APK with a fake gadget
+    """
+    gadget_path = tmp_path.joinpath(GADGET_NAME)
+    gadget_path.write_bytes(b'gadget')
+    return InjectionContext(apk_path, 'arm64', tmp_path.joinpath('demo'), str(gadget_path), **kwargs)
+
+
+def write_smali(decompiled_path, class_name, text):
+    """Write a smali class into the decompiled directory
+    """
+    smali_path = decompiled_path.joinpath('smali', *class_name.split('.')).with_suffix('.smali')
+    smali_path.parent.mkdir(parents=True, exist_ok=True)
+    smali_path.write_text(text, encoding='utf-8')
+    return smali_path
+
+
+def test_apk_probe(tmp_path):
+    """test reading the binary manifest of the APK
+    """
+    apk_path = build_apk(
+        tmp_path,
+        application={'android:name': '.App', 'android:extractNativeLibs': False},
+        components=[
+            ('provider', {'android:name': '.Disabled', 'android:enabled': False}, []),
+            ('provider', {'android:name': '.Resource', 'android:enabled': 0x7f050001}, []),
+            ('provider', {'android:name': '.Remote', 'android:process': ':remote'}, []),
+            ('provider', {'android:name': 'Main', 'android:process': 'com.example'}, []),
+            ('provider', {'android:name': 'androidx.startup.InitializationProvider',
+                          'android:enabled': True}, []),
+        ],
+        permissions=['android.permission.INTERNET'])
+    probe = ApkProbe(str(apk_path))
+
+    assert probe.application_class() == 'com.example.App'
+    assert probe.provider_classes() == ['com.example.Main', 'androidx.startup.InitializationProvider']
+    assert probe.has_permission('android.permission.INTERNET')
+    assert not probe.has_permission('android.permission.CAMERA')
+    assert not probe.extracts_native_libs()
+
+    probe = ApkProbe(str(build_apk(tmp_path)))
+    assert probe.application_class() is None
+    assert probe.provider_classes() == []
+    assert probe.extracts_native_libs()
+
+
+def strategy_names(context, name='auto'):
+    """Return the names of the selected strategies
+    """
+    return [strategy.name for strategy in select_strategies(context, name)]
+
+
+def test_select_strategies(tmp_path):
+    """test the cost ordering and the applicability probes
+    """
+    so_path = tmp_path.joinpath('libnative.so')
+    build_shared_library(so_path)
+    apk_path = build_apk(tmp_path, application={'android:name': '.App'},
+                         components=[('provider', {'android:name': '.Provider'}, [])],
+                         permissions=['android.permission.INTERNET'],
+                         libraries=[('libnative.so', so_path)])
+
+    assert strategy_names(build_context(tmp_path, apk_path)) == ['activity', 'provider', 'application']
+    assert strategy_names(build_context(tmp_path, apk_path, main_activity='com.example.Main')) == \
+        ['activity']
+    assert strategy_names(build_context(tmp_path, apk_path, native_lib='native')) == \
+        ['native-lib-zip', 'native-lib', 'activity', 'provider', 'application']
+    assert strategy_names(build_context(tmp_path, apk_path, native_lib='native', allow_zip=False)) == \
+        ['native-lib', 'activity', 'provider', 'application']
+    assert strategy_names(build_context(tmp_path, apk_path, native_lib='missing')) == \
+        ['activity', 'provider', 'application']
+    assert strategy_names(build_context(tmp_path, apk_path, decoded=DECODE_FULL), 'provider') == \
+        ['provider']
+    # A directory decoded with --no-src and given with --skip-decompile has no smali
+    assert strategy_names(build_context(tmp_path, apk_path, native_lib='native', allow_zip=False,
+                                        decoded=DECODE_RESOURCES)) == ['native-lib']
+
+    # The manifest cannot be patched without apktool
+    apk_path = build_apk(tmp_path, libraries=[('libnative.so', so_path)])
+    assert strategy_names(build_context(tmp_path, apk_path, native_lib='native')) == \
+        ['native-lib', 'activity']
+
+
+def test_native_lib_zip_strategy(tmp_path):
+    """test patching the native library without apktool
+    """
+    so_path = tmp_path.joinpath('libnative.so')
+    build_shared_library(so_path)
+    apk_path = build_apk(tmp_path, permissions=['android.permission.INTERNET'],
+                         libraries=[('libnative.so', so_path)])
+    context = build_context(tmp_path, apk_path, native_lib='libnative.so')
+    NativeLibZipStrategy().inject(context)
+
+    with zipfile.ZipFile(tmp_path.joinpath('demo', 'dist', 'demo.apk')) as apk:
+        assert 'META-INF/CERT.RSA' not in apk.namelist()
+        assert apk.read('lib/arm64-v8a/lib' + GADGET_NAME) == b'gadget'
+        arsc = apk.getinfo('resources.arsc')
+        assert (arsc.header_offset + 30 + len(arsc.filename) + len(arsc.extra)) % 4 == 0
+        so_path.write_bytes(apk.read('lib/arm64-v8a/libnative.so'))
+    assert get_needed_libraries(str(so_path))[0] == 'lib' + GADGET_NAME
+
+
+def test_insert_loadlibary_locals(tmp_path):
+    """test reserving a local register in an entrypoint without locals
+    """
+    smali_path = write_smali(tmp_path, 'com.example.App',
+                             '.class public Lcom/example/App;\n'
+                             '.method public constructor <init>()V\n'
+                             '    .locals 0\n'
+                             '    invoke-direct {p0}, Landroid/app/Application;-><init>()V\n'
+                             '    return-void\n'
+                             '.end method\n')
+    insert_loadlibary(tmp_path, 'com.example.App', 'libfrida-gadget', entrypoints=("<init>",))
+
+    lines = smali_path.read_text(encoding='utf-8').split('\n')
+    assert lines[2:5] == ['    .locals 1', '    const-string v0, "frida-gadget"',
+                          '    invoke-static {v0}, '
+                          'Ljava/lang/System;->loadLibrary(Ljava/lang/String;)V']
+
+
+def test_application_strategy_entrypoints(tmp_path):
+    """test skipping the constructor overloads the framework never calls
+    """
+    context = build_context(tmp_path, build_apk(tmp_path, application={'android:name': '.App'}))
+    context.decompiled_path.mkdir()
+    overload = ('.method public synthetic constructor '
+                '<init>(ILkotlin/jvm/internal/DefaultConstructorMarker;)V\n'
+                '    .locals 0\n'
+                '    return-void\n'
+                '.end method\n')
+    smali_path = write_smali(context.decompiled_path, 'com.example.App',
+                             '.class public Lcom/example/App;\n' + overload +
+                             '.method public constructor <init>()V\n'
+                             '    .locals 0\n'
+                             '    return-void\n'
+                             '.end method\n')
+    ApplicationStrategy().inject(context)
+    assert smali_path.read_text(encoding='utf-8').index('loadLibrary') > \
+        smali_path.read_text(encoding='utf-8').index('constructor <init>()V')
+
+    write_smali(context.decompiled_path, 'com.example.App',
+                '.class public Lcom/example/App;\n' + overload)
+    with pytest.raises(InjectionError):
+        ApplicationStrategy().inject(context)
+
+
+class FailingStrategy(InjectionStrategy):
+    """ Strategy that always fails after a resources only decode """
+
+    name = 'failing'
+    decode = DECODE_RESOURCES
+
+    def is_applicable(self, context):
+        return True
+
+    def inject(self, context):
+        raise InjectionError("failing on purpose")
+
+
+def test_inject_gadget_fallback(tmp_path, monkeypatch):
+    """test falling back to the next strategy and decoding further for it
+    """
+    apk_path = build_apk(tmp_path, components=[
+        ('provider', {'android:name': '.Missing'}, []),
+        ('provider', {'android:name': '.Provider'}, []),
+    ])
+    gadget_path = tmp_path.joinpath(GADGET_NAME)
+    gadget_path.write_bytes(b'gadget')
+    decompiled_path = tmp_path.joinpath('demo')
+
+    decodes = []
+    def decompile_apk(_, path, decode):
+        decodes.append(decode)
+        path.mkdir(exist_ok=True)
+        path.joinpath('AndroidManifest.xml').write_text(
+            '<manifest package="com.example">\n</manifest>\n', encoding='utf-8')
+        if decode == DECODE_FULL:
+            write_smali(path, 'com.example.Provider',
+                        '.class public Lcom/example/Provider;\n'
+                        '.method public onCreate()Z\n'
+                        '    .locals 1\n'
+                        '    const/4 v0, 0x1\n'
+                        '    return v0\n'
+                        '.end method\n')
+
+    monkeypatch.setattr(strategies, 'STRATEGIES', [FailingStrategy(), ProviderStrategy()])
+    monkeypatch.setattr(cli, 'download_gadget', lambda arch: str(gadget_path))
+    monkeypatch.setattr(cli, 'decompile_apk', decompile_apk)
+    injected_by = cli.inject_gadget_into_apk(apk_path, 'arm64', decompiled_path)
+
+    assert injected_by.name == 'provider'
+    assert decodes == [DECODE_RESOURCES, DECODE_FULL]
+    smali = decompiled_path.joinpath('smali', 'com', 'example', 'Provider.smali')
+    assert 'const-string v0, "frida-gadget-16.0.0-android-arm64"' in smali.read_text(encoding='utf-8')
+    assert decompiled_path.joinpath('lib', 'arm64-v8a', 'lib' + GADGET_NAME).read_bytes() == b'gadget'
+    assert 'android.permission.INTERNET' in \
+        decompiled_path.joinpath('AndroidManifest.xml').read_text(encoding='utf-8')
+
+
+LAUNCHER_FILTER = ('intent-filter', {}, [
+    ('action', {'android:name': 'android.intent.action.MAIN'}, []),
+    ('category', {'android:name': 'android.intent.category.LAUNCHER'}, []),
+])
+
+
+def write_text_manifest(decompiled_path, components):
+    """Write the decoded manifest apktool would produce for the components
+    """
+    def element(tag, attributes, children):
+        encoded = ''.join(f' {name}="{str(value).lower() if isinstance(value, bool) else value}"'
+                          for name, value in attributes.items())
+        return f'<{tag}{encoded}>' + ''.join(element(*child) for child in children) + f'</{tag}>'
+
+    decompiled_path.joinpath('AndroidManifest.xml').write_text(
+        f'<manifest xmlns:android="{ANDROID_URI}" package="com.example">'
+        + element('application', {}, components) + '</manifest>', encoding='utf-8')
+
+
+@pytest.mark.parametrize('components, expected', [
+    ([('activity', {'android:name': '.Main'}, [LAUNCHER_FILTER])], 'com.example.Main'),
+    ([('activity', {'android:name': 'Main'}, [LAUNCHER_FILTER])], 'com.example.Main'),
+    ([('activity', {'android:name': 'org.other.Main'}, [LAUNCHER_FILTER])], 'org.other.Main'),
+    # Several launchers select the alphabetically first one, not the first in the manifest
+    ([('activity', {'android:name': '.Second'}, [LAUNCHER_FILTER]),
+      ('activity', {'android:name': '.First'}, [LAUNCHER_FILTER])], 'com.example.First'),
+    ([('activity-alias', {'android:name': '.Alias', 'android:targetActivity': '.Zed'},
+       [LAUNCHER_FILTER]),
+      ('activity', {'android:name': '.Zed'}, [LAUNCHER_FILTER])], 'com.example.Zed'),
+    ([('activity', {'android:name': '.Disabled', 'android:enabled': False}, [LAUNCHER_FILTER]),
+      ('activity', {'android:name': '.Main'}, [LAUNCHER_FILTER])], 'com.example.Main'),
+    ([('activity', {'android:name': '.Other'}, [('intent-filter', {}, LAUNCHER_FILTER[2][:1])])],
+     None),
+])
+def test_get_main_activity_from_manifest(tmp_path, components, expected):
+    """test finding the same launcher activity as androguard in the decoded manifest
+    """
+    write_text_manifest(tmp_path, components)
+    assert get_main_activity_from_manifest(tmp_path) == expected
+    assert APK(str(build_apk(tmp_path, components=components))).get_main_activity() == expected
+
+
+def test_get_main_activity_from_binary_manifest(tmp_path):
+    """test giving up on a manifest left binary by --no-res
+    """
+    tmp_path.joinpath('AndroidManifest.xml').write_bytes(b'\x03\x00\x08\x00\x00\x00\x00\x00')
+    assert get_main_activity_from_manifest(tmp_path) is None